@@ -1,35 +1,130 @@
 """
-Common utilities for socket framing and simple message protocol using pickle.
+Common utilities for socket framing and simple message protocol using msgpack.
 Messages are Python dicts with at least a "type" field.
-Framing: 4-byte big-endian length prefix, followed by pickled payload.
+Framing: 4-byte big-endian length prefix, followed by msgpack-encoded payload.
+A message may carry a raw binary body: the payload then has a "body_len" field and
+the body bytes follow the payload on the wire, outside the msgpack encoding. The
+receiver exposes them as msg["body"].
 """
 
-import pickle
+import asyncio
+import gc
 import socket
 import struct
-from typing import Dict, Any
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+
+import msgspec
 
 LENGTH_PREFIX_FMT = "!I"  # 4 bytes, big-endian unsigned int
+HEADER_SIZE = struct.calcsize(LENGTH_PREFIX_FMT)
+BODY_LEN_KEY = "body_len"  # payload field announcing a raw body after the payload
+SOCK_BUF_SIZE = 4 << 20   # 4 MiB kernel send/recv buffers for multi-MB JOB payloads
+RECV_BUF_SIZE = 1 << 20   # initial size of the per-thread recv_msg scratch buffer
+
+# Reusable codec instances; bytes values pass through as msgpack bin.
+_ENC = msgspec.msgpack.Encoder()
+_DEC = msgspec.msgpack.Decoder()
+
+_local = threading.local()
+
+@contextmanager
+def gc_paused():
+    """Suspend the cyclic GC while decoding, so allocation bursts don't trigger collections."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def tune_socket(sock: socket.socket) -> None:
+    """Disable Nagle (small request/response messages) and enlarge socket buffers."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+
+def send_buffers(sock: socket.socket, buffers: List[Any]) -> None:
+    """Send several buffers back to back without concatenating them first."""
+    if not hasattr(sock, "sendmsg"):  # Windows: no scatter-gather send
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(b).cast("B") for b in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop fully sent buffers and trim a partially sent one
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+def _frame(msg: Dict[str, Any], body: Optional[Any]) -> List[Any]:
+    if body is not None:
+        msg = {**msg, BODY_LEN_KEY: len(body)}
+    payload = _ENC.encode(msg)
+    frame = [struct.pack(LENGTH_PREFIX_FMT, len(payload)), payload]
+    if body is not None:
+        frame.append(body)  # sent as-is: no copy into the msgpack payload
+    return frame
 
-def send_msg(sock: socket.socket, msg: Dict[str, Any]) -> None:
-    """Serialize and send a dict message with length prefix."""
-    payload = pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
-    header = struct.pack(LENGTH_PREFIX_FMT, len(payload))
-    sock.sendall(header + payload)
-
-def recv_exact(sock: socket.socket, n: int) -> bytes:
-    """Receive exactly n bytes or raise ConnectionError."""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
+def send_msg(sock: socket.socket, msg: Dict[str, Any], body: Optional[Any] = None) -> None:
+    """Serialize and send a dict message with length prefix and optional raw body."""
+    send_buffers(sock, _frame(msg, body))
+
+def recv_exact_into(sock: socket.socket, view: memoryview) -> None:
+    """Fill view completely from the socket or raise ConnectionError."""
+    pos = 0
+    n = len(view)
+    while pos < n:
+        nread = sock.recv_into(view[pos:])
+        if not nread:
             raise ConnectionError("Socket closed during recv_exact")
-        buf.extend(chunk)
-    return bytes(buf)
+        pos += nread
+
+def recv_exact(sock: socket.socket, n: int) -> bytearray:
+    """Receive exactly n bytes into a new buffer or raise ConnectionError."""
+    buf = bytearray(n)
+    recv_exact_into(sock, memoryview(buf))
+    return buf
+
+def _recv_buffer(n: int) -> memoryview:
+    # Per-thread scratch buffer for frames that are decoded immediately; grown on demand
+    buf = getattr(_local, "recv_buf", None)
+    if buf is None or len(buf) < n:
+        buf = bytearray(max(n, RECV_BUF_SIZE))
+        _local.recv_buf = buf
+    return memoryview(buf)[:n]
 
 def recv_msg(sock: socket.socket) -> Dict[str, Any]:
-    """Receive a dict message with length prefix and unpickle it."""
-    header = recv_exact(sock, struct.calcsize(LENGTH_PREFIX_FMT))
+    """Receive a dict message with length prefix and decode it."""
+    header = _recv_buffer(HEADER_SIZE)
+    recv_exact_into(sock, header)
+    (length,) = struct.unpack(LENGTH_PREFIX_FMT, header)
+    payload = _recv_buffer(length)
+    recv_exact_into(sock, payload)
+    with gc_paused():
+        msg = _DEC.decode(payload)  # copies out str/bytes values, so the buffer can be reused
+    if BODY_LEN_KEY in msg:
+        # The body outlives this call (e.g. Arrow tables reference it), so it gets its own buffer
+        msg["body"] = recv_exact(sock, msg.pop(BODY_LEN_KEY))
+    return msg
+
+async def send_msg_async(writer: asyncio.StreamWriter, msg: Dict[str, Any], body: Optional[Any] = None) -> None:
+    """asyncio variant of send_msg."""
+    writer.writelines(_frame(msg, body))
+    await writer.drain()
+
+async def recv_msg_async(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    """asyncio variant of recv_msg; raises asyncio.IncompleteReadError on EOF."""
+    header = await reader.readexactly(HEADER_SIZE)
     (length,) = struct.unpack(LENGTH_PREFIX_FMT, header)
-    payload = recv_exact(sock, length)
-    return pickle.loads(payload)
+    payload = await reader.readexactly(length)
+    with gc_paused():
+        msg = _DEC.decode(payload)
+    if BODY_LEN_KEY in msg:
+        msg["body"] = await reader.readexactly(msg.pop(BODY_LEN_KEY))
+    return msg
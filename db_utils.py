@@ -4,8 +4,8 @@ Switching to PostgreSQL/MySQL: replace sqlite3 code with appropriate connectors
 """
 
 import sqlite3
-from contextlib import contextmanager
-from typing import Optional, Tuple, Dict, Any
+import threading
+from typing import Optional, Tuple, Dict, Any, List
 from datetime import datetime
 
 SCHEMA_SQL = """
@@ -23,6 +23,17 @@ CREATE TABLE IF NOT EXISTS worker_results (
 );
 """
 
+# Per-connection settings for the bulk-insert writer. With WAL, synchronous=NORMAL
+# only fsyncs at checkpoints; a crash can lose the last commits, which just means
+# rerunning the affected chunks.
+TUNE_SQL = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA wal_autocheckpoint=10000;
+"""
+
 UPSERT_SQL = """
 INSERT INTO worker_results (worker_id, chunk_id, rows_processed, total_sales, min_price, max_price, avg_price, inserted_at)
 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -49,45 +60,86 @@ SELECT
 FROM worker_results;
 """
 
-@contextmanager
-def connect(db_path: str):
-    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)  # autocommit
-    try:
-        yield conn
-    finally:
-        conn.close()
-
-def init_db(db_path: str) -> None:
-    with connect(db_path) as conn:
-        cur = conn.cursor()
-        for stmt in SCHEMA_SQL.strip().split(";"):
-            if stmt.strip():
-                cur.execute(stmt)
-        cur.close()
+def open_db(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)  # autocommit
+
+def _execute_script(conn: sqlite3.Connection, script: str) -> None:
+    cur = conn.cursor()
+    for stmt in script.strip().split(";"):
+        if stmt.strip():
+            cur.execute(stmt)
+    cur.close()
+
+def tune_db(conn: sqlite3.Connection) -> None:
+    _execute_script(conn, TUNE_SQL)
+
+def _record_row(record: Dict[str, Any]) -> Tuple:
+    return (
+        record["worker_id"],
+        record["chunk_id"],
+        record["rows_processed"],
+        record["total_sales"],
+        record["min_price"],
+        record["max_price"],
+        record["avg_price"],
+        record.get("inserted_at") or datetime.utcnow().isoformat()
+    )
 
-def upsert_partial(db_path: str, record: Dict[str, Any]) -> None:
-    with connect(db_path) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            UPSERT_SQL,
-            (
-                record["worker_id"],
-                record["chunk_id"],
-                record["rows_processed"],
-                record["total_sales"],
-                record["min_price"],
-                record["max_price"],
-                record["avg_price"],
-                record.get("inserted_at") or datetime.utcnow().isoformat()
-            )
-        )
+class DB:
+    """
+    Handle to one SQLite database file. Each thread lazily opens, tunes and then
+    reuses its own connection, so calls don't pay connect + PRAGMA setup.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_db(self.db_path)
+            tune_db(conn)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def init(self) -> None:
+        _execute_script(self.conn, SCHEMA_SQL)
+
+    def upsert_partial(self, record: Dict[str, Any]) -> None:
+        cur = self.conn.cursor()
+        cur.execute(UPSERT_SQL, _record_row(record))
         cur.close()
 
-def final_aggregate(db_path: str) -> Dict[str, Any]:
-    with connect(db_path) as conn:
-        cur = conn.cursor()
+    def upsert_many(self, records: List[Dict[str, Any]]) -> None:
+        """Upsert a batch of records in a single transaction (one fsync per batch)."""
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.executemany(UPSERT_SQL, [_record_row(r) for r in records])
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        else:
+            cur.execute("COMMIT")
+        finally:
+            cur.close()
+
+    def final_aggregate(self) -> Dict[str, Any]:
+        cur = self.conn.cursor()
         cur.execute(AGGREGATE_SQL)
         row = cur.fetchone()
         cur.close()
-    keys = ["total_rows", "total_sales", "min_price", "max_price", "avg_price"]
-    return dict(zip(keys, row)) if row else {k: None for k in keys}
+        keys = ["total_rows", "total_sales", "min_price", "max_price", "avg_price"]
+        return dict(zip(keys, row)) if row else {k: None for k in keys}
+
+    def close(self) -> None:
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
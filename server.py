@@ -1,167 +1,425 @@
 """
 Coordinator server:
-- Loads CSV with pandas
+- Streams the price/quantity columns of the CSV with pyarrow
 - Splits into chunks
-- Distributes chunks to worker nodes over TCP using a pull-based protocol
-- Receives partial metrics and writes to SQLite
+- Distributes chunks to worker nodes over TCP using a pull-based protocol (asyncio, uvloop if installed)
+- Receives partial metrics, writes them to SQLite and folds them into a running aggregate
 - Prints final aggregate once all chunks are processed
 
 Usage:
-    python server.py --csv /path/to/sales.csv --host 0.0.0.0 --port 5000 --chunks 100 --db results.sqlite
+    python server.py --csv /path/to/sales.csv --host 0.0.0.0 --port 5000 --chunks 100 --db results.sqlite [--compress lz4]
 """
 
 import argparse
+import asyncio
+import csv
+import math
 import socket
 import threading
 import queue
-import time
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 
-from common import send_msg, recv_msg
-from db_utils import init_db, upsert_partial, final_aggregate
+try:
+    import uvloop
+except ImportError:  # not available on Windows; fall back to the default asyncio loop
+    uvloop = None
+
+from common import send_msg_async, recv_msg_async, tune_socket, gc_paused
+from db_utils import DB
 
 # ---- Protocol message types ----
 MSG_HELLO = "HELLO"         # from worker -> server, includes worker_id
 MSG_GET_JOB = "GET_JOB"     # from worker -> server, request a chunk
-MSG_JOB = "JOB"             # from server -> worker, includes chunk_id and data (bytes of pickled df)
+MSG_JOB = "JOB"             # from server -> worker, includes chunk_id; Arrow IPC stream sent as raw body
 MSG_NO_JOB = "NO_JOB"       # from server -> worker, no more chunks
 MSG_RESULT = "RESULT"       # from worker -> server, includes metrics
 MSG_BYE = "BYE"             # from worker -> server, disconnecting
+MSG_ERROR = "ERROR"         # from server -> worker, malformed message; connection is closed
+
+# ---- Column names in JOB payloads ----
+PRICE_COL = "price"
+QTY_COL = "quantity"
+
+# ---- Numeric fields every RESULT record must carry ----
+RECORD_FIELDS = ("chunk_id", "rows_processed", "total_sales", "min_price", "max_price", "avg_price")
+
+CSV_BLOCK_SIZE = 64 << 20  # bytes of CSV parsed per Arrow record batch
+# Values accepted by coerce_float: decimals/exponents, inf and nan (after trimming)
+NUMBER_PATTERN = r"^(?i:[+-]?(\d+\.?\d*|\.\d+)(e[+-]?\d+)?|[+-]?(inf|infinity|nan))$"
+WRITE_BATCH_SIZE = 256  # max RESULT records committed per SQLite transaction
+READ_TIMEOUT = 300      # seconds a worker connection may stay silent
+SHUTDOWN_GRACE = 5      # seconds to let workers disconnect once all chunks are done
 
 class Chunk:
     __slots__ = ("chunk_id", "payload")
-    def __init__(self, chunk_id: int, payload: bytes):
+    def __init__(self, chunk_id: int, payload: memoryview):
         self.chunk_id = chunk_id
         self.payload = payload
 
-def chunk_dataframe(df: pd.DataFrame, n_chunks: int) -> List[pd.DataFrame]:
-    # split by indices to keep memory reasonable
-    return list((df.iloc[s] for s in pd.IndexSlice[pd.Series(range(len(df))).to_numpy().reshape(-1)]))  # placeholder to satisfy linter
-    # (We will override below because certain linters complain about np splits when numpy not imported.)
-
-def split_dataframe(df: pd.DataFrame, n_chunks: int) -> List[pd.DataFrame]:
-    # Use numpy-style array split without importing numpy explicitly
-    length = len(df)
-    base = length // n_chunks
-    rem = length % n_chunks
-    chunks = []
-    start = 0
-    for i in range(n_chunks):
-        size = base + (1 if i < rem else 0)
-        end = start + size
-        if start < end:
-            chunks.append(df.iloc[start:end])
-        start = end
-    return chunks
+def split_table(table: pa.Table, n_chunks: int) -> List[pa.Table]:
+    # Same boundaries as np.array_split (first len % n_chunks parts get one extra row),
+    # computed in one shot; Table.slice is a zero-copy view, not an iloc-style copy
+    base, rem = divmod(table.num_rows, n_chunks)
+    sizes = np.full(n_chunks, base, dtype=np.int64)
+    sizes[:rem] += 1
+    offsets = np.cumsum(sizes) - sizes
+    return [table.slice(off, size) for off, size in zip(offsets.tolist(), sizes.tolist()) if size]
 
-def build_chunks(df: pd.DataFrame, n_chunks: int) -> List[Chunk]:
-    import pickle
-    chunks = []
-    for i, part in enumerate(split_dataframe(df, n_chunks)):
-        payload = pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL)
-        chunks.append(Chunk(i, payload))
-    return chunks
+def write_ipc(sink: pa.NativeFile, table: pa.Table, compression: Optional[str] = None) -> None:
+    # Arrow IPC stream: columnar buffers written as-is, no per-object walk like pickle.
+    # With compression ("lz4"/"zstd") each buffer is compressed; readers decompress transparently.
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+def ipc_size(table: pa.Table) -> int:
+    # Stream length without materializing it: MockOutputStream only counts bytes
+    sink = pa.MockOutputStream()
+    write_ipc(sink, table)
+    return sink.size()
+
+def find_columns(columns) -> Tuple[str, str]:
+    # Try to robustly find price and quantity columns
+    cols = {c.lower(): c for c in columns}
+    price_col = None
+    for cand in ["price", "unitprice", "unit_price"]:
+        if cand in cols:
+            price_col = cols[cand]
+            break
+    if price_col is None:
+        raise ValueError(f"Could not find a price column among: {list(columns)}")
 
-def worker_handler(conn: socket.socket, addr, job_queue: queue.Queue, db_path: str, results_counter, results_lock):
-    conn.settimeout(300)
-    worker_id = None
+    qty_col = None
+    for cand in ["quantity", "qty", "units"]:
+        if cand in cols:
+            qty_col = cols[cand]
+            break
+    if qty_col is None:
+        raise ValueError(f"Could not find a quantity column among: {list(columns)}")
+    return price_col, qty_col
+
+def read_columns(csv_path: str) -> List[str]:
+    # Header row only, to resolve price/quantity names before the Arrow reader starts
+    with open(csv_path, newline="") as f:
+        return next(csv.reader(f))
+
+def coerce_float(arr: pa.Array, type: pa.DataType) -> pa.Array:
+    # String column -> float with unparseable values as null (like pd.to_numeric(errors="coerce"))
+    arr = pc.utf8_trim_whitespace(arr)
     try:
-        # Expect HELLO first (optional), then GET_JOB / RESULT loop
+        return pc.cast(arr, type)
+    except pa.ArrowInvalid:
+        numeric = pc.match_substring_regex(arr, NUMBER_PATTERN)
+        return pc.cast(pc.if_else(numeric, arr, pa.scalar(None, pa.string())), type)
+
+def load_table(csv_path: str) -> pa.Table:
+    # Stream the CSV in blocks, parsing only the price/quantity columns.
+    # Workers receive them as PRICE_COL/QTY_COL in float32 (~7 significant digits
+    # is plenty for prices and quantities, and it halves the bytes shipped).
+    # Columns are read as strings and coerced per batch, so a stray "$3.00" becomes
+    # a missing value instead of aborting the load.
+    price_col, qty_col = find_columns(read_columns(csv_path))
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=[price_col, qty_col],
+            column_types={price_col: pa.string(), qty_col: pa.string()},
+        ),
+    )
+    schema = pa.schema([(PRICE_COL, pa.float32()), (QTY_COL, pa.float32())])
+    batches = (
+        pa.RecordBatch.from_arrays([coerce_float(col, f.type) for col, f in zip(b.columns, schema)], schema=schema)
+        for b in reader
+    )
+    return pa.Table.from_batches(batches, schema=schema)
+
+def build_chunks(table: pa.Table, n_chunks: int, compression: Optional[str] = None) -> List[Chunk]:
+    # Serialize every chunk once into a single arena; each Chunk holds a memoryview
+    # slice (offset, length) of it, so handing a chunk out never copies or re-serializes
+    parts = split_table(table, n_chunks)
+    with gc_paused():
+        if compression is None:
+            # Sizes are known up front, so streams are written straight into the arena
+            encoded = None
+            sizes = [ipc_size(part) for part in parts]
+        else:
+            # Compressed sizes are only known after compressing; copy those (smaller) bytes in
+            encoded = []
+            for part in parts:
+                sink = pa.BufferOutputStream()
+                write_ipc(sink, part, compression)
+                encoded.append(sink.getvalue())
+            sizes = [buf.size for buf in encoded]
+        arena = memoryview(bytearray(sum(sizes)))
+        chunks = []
+        offset = 0
+        for i, size in enumerate(sizes):
+            view = arena[offset:offset + size]
+            if encoded is None:
+                write_ipc(pa.FixedSizeBufferWriter(pa.py_buffer(view)), parts[i])
+            else:
+                view[:] = memoryview(encoded[i]).cast("B")
+            chunks.append(Chunk(i, view))
+            offset += size
+    return chunks
+
+def new_aggregate() -> Dict[str, Any]:
+    return {"total_rows": 0, "total_sales": 0.0, "min_price": math.inf, "max_price": -math.inf, "weighted_sum": 0.0}
+
+def fold_result(agg: Dict[str, Any], record: Dict[str, Any]) -> None:
+    rows = record["rows_processed"]
+    agg["total_rows"] += rows
+    agg["total_sales"] += record["total_sales"]
+    agg["weighted_sum"] += record["avg_price"] * rows
+    if rows:  # empty chunks report 0.0 placeholders for min/max
+        agg["min_price"] = min(agg["min_price"], record["min_price"])
+        agg["max_price"] = max(agg["max_price"], record["max_price"])
+
+def finalize_aggregate(agg: Dict[str, Any]) -> Dict[str, Any]:
+    # Same shape as DB.final_aggregate (weighted mean of per-chunk averages)
+    rows = agg["total_rows"]
+    return {
+        "total_rows": rows,
+        "total_sales": agg["total_sales"],
+        "min_price": agg["min_price"] if rows else None,
+        "max_price": agg["max_price"] if rows else None,
+        "avg_price": agg["weighted_sum"] / rows if rows else None,
+    }
+
+def writer_loop(db: DB, results_queue: queue.Queue, results_counter, results_lock, agg: Dict[str, Any],
+                total_jobs: int, done_event: threading.Event):
+    # Single writer thread: commits records in batches on its own cached connection
+    # and folds them into the in-memory aggregate. SQLite stays the durable log.
+    # A None item flushes what is pending and stops the loop.
+    seen = set()  # (worker_id, chunk_id) already folded; resent RESULTs only re-upsert
+    dropped = set()  # (worker_id, chunk_id) ACKed but never committed; still counted as progress
+    stop = False
+    while not stop:
+        batch = []
+        item = results_queue.get()
         while True:
-            msg = recv_msg(conn)
-            mtype = msg.get("type")
-            if mtype == MSG_HELLO:
-                worker_id = msg.get("worker_id") or f"{addr[0]}:{addr[1]}"
-            elif mtype == MSG_GET_JOB:
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                break
+            try:
+                item = results_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not batch:
+            continue
+        lost = []
+        try:
+            db.upsert_many(batch)
+            committed = batch
+        except Exception as e:
+            # Don't let one bad record discard the rest of the batch (or kill this thread)
+            print(f"[Server] Batch upsert of {len(batch)} results failed ({e!r}); retrying one by one")
+            committed = []
+            for record in batch:
                 try:
-                    chunk: Chunk = job_queue.get_nowait()
-                except queue.Empty:
-                    send_msg(conn, {"type": MSG_NO_JOB})
+                    db.upsert_partial(record)
+                except Exception as e:
+                    print(f"[Server] Dropping result for chunk {record.get('chunk_id')}: {e!r}")
+                    lost.append(record)
                 else:
-                    send_msg(conn, {"type": MSG_JOB, "chunk_id": chunk.chunk_id, "data": chunk.payload})
-            elif mtype == MSG_RESULT:
-                record = msg.get("record", {})
-                if worker_id and "worker_id" not in record:
-                    record["worker_id"] = worker_id
-                record["inserted_at"] = datetime.utcnow().isoformat()
-                upsert_partial(db_path, record)
-                with results_lock:
-                    results_counter["count"] += 1
-                # Acknowledge
-                send_msg(conn, {"type": "ACK", "chunk_id": record.get("chunk_id")})
-            elif mtype == MSG_BYE:
+                    committed.append(record)
+        fresh = []
+        progressed = 0
+        for record in committed:
+            key = (record["worker_id"], record["chunk_id"])
+            if key not in seen:
+                seen.add(key)
+                fresh.append(record)
+                if key in dropped:
+                    dropped.discard(key)  # a resend made it in after all; already counted
+                else:
+                    progressed += 1
+        # The worker was ACKed and won't resend, so a dropped result still counts
+        # towards completion; otherwise the server would wait for it forever
+        for record in lost:
+            key = (record["worker_id"], record["chunk_id"])
+            if key not in seen and key not in dropped:
+                dropped.add(key)
+                progressed += 1
+        if progressed or fresh:
+            with results_lock:
+                for record in fresh:
+                    fold_result(agg, record)
+                results_counter["count"] += progressed
+                results_counter["dropped"] = len(dropped)
+                if results_counter["count"] >= total_jobs:
+                    done_event.set()
+
+class Session:
+    """Per-connection state shared by the message handlers."""
+    __slots__ = ("writer", "addr", "worker_id", "job_queue", "results_queue")
+    def __init__(self, writer: asyncio.StreamWriter, job_queue: asyncio.Queue, results_queue: queue.Queue):
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.worker_id = None
+        self.job_queue = job_queue
+        self.results_queue = results_queue
+
+# Message handlers return True when the connection should end.
+
+async def _handle_hello(session: Session, msg: Dict[str, Any]) -> bool:
+    session.worker_id = msg.get("worker_id") or f"{session.addr[0]}:{session.addr[1]}"
+    return False
+
+async def _handle_get_job(session: Session, msg: Dict[str, Any]) -> bool:
+    try:
+        chunk: Chunk = session.job_queue.get_nowait()
+    except asyncio.QueueEmpty:
+        await send_msg_async(session.writer, {"type": MSG_NO_JOB})
+    else:
+        await send_msg_async(session.writer, {"type": MSG_JOB, "chunk_id": chunk.chunk_id}, body=chunk.payload)
+    return False
+
+def check_record(record: Any) -> Optional[str]:
+    # Returns a description of what is wrong with a RESULT record, or None if it is usable
+    if not isinstance(record, dict):
+        return "record is not a map"
+    for key in RECORD_FIELDS:
+        value = record.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return f"record field {key!r} is missing or not a number"
+        if value != value:
+            return f"record field {key!r} is NaN"
+    if record.get("worker_id") is not None and not isinstance(record["worker_id"], str):
+        return "record field 'worker_id' is not a string"
+    return None
+
+async def _handle_result(session: Session, msg: Dict[str, Any]) -> bool:
+    record = msg.get("record")
+    # Validate before queueing and ACKing: the writer thread only sees usable records
+    error = check_record(record)
+    if error is not None:
+        print(f"[Server] Rejecting RESULT from {session.addr}: {error}")
+        await send_msg_async(session.writer, {"type": MSG_ERROR, "error": error})
+        return True
+    if not record.get("worker_id"):
+        record["worker_id"] = session.worker_id or f"{session.addr[0]}:{session.addr[1]}"
+    record["inserted_at"] = datetime.utcnow().isoformat()
+    session.results_queue.put(record)
+    # Acknowledge (optimistically: the writer thread commits in batches)
+    await send_msg_async(session.writer, {"type": "ACK", "chunk_id": record.get("chunk_id")})
+    return False
+
+async def _handle_bye(session: Session, msg: Dict[str, Any]) -> bool:
+    return True
+
+HANDLERS = {
+    MSG_HELLO: _handle_hello,
+    MSG_GET_JOB: _handle_get_job,
+    MSG_RESULT: _handle_result,
+    MSG_BYE: _handle_bye,
+}
+
+async def worker_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, job_queue: asyncio.Queue, results_queue: queue.Queue):
+    tune_socket(writer.get_extra_info("socket"))
+    session = Session(writer, job_queue, results_queue)
+    try:
+        # Expect HELLO first (optional), then GET_JOB / RESULT loop
+        while True:
+            msg = await asyncio.wait_for(recv_msg_async(reader), timeout=READ_TIMEOUT)
+            handler = HANDLERS.get(msg.get("type"))
+            if handler is None:
+                # unknown: ignore
+                continue
+            if await handler(session, msg):
                 break
-            else:
-                # unknown: ignore or ack
-                pass
     except Exception as e:
         # Log error (print for simplicity)
-        print(f"[Server] Error with {addr}: {e}")
+        print(f"[Server] Error with {session.addr}: {e!r}")
     finally:
-        conn.close()
-
-def serve(csv_path: str, host: str, port: int, n_chunks: int, db_path: str):
-    print(f"[Server] Loading CSV: {csv_path}")
-    df = pd.read_csv(csv_path)
-    print(f"[Server] Loaded {len(df):,} rows. Splitting into {n_chunks} chunks...")
-    chunks = build_chunks(df, n_chunks)
+        writer.close()
 
-    print(f"[Server] Initializing DB at {db_path}")
-    init_db(db_path)
-
-    job_queue: queue.Queue = queue.Queue()
+async def coordinate(host: str, port: int, chunks: List[Chunk], results_queue: queue.Queue, results_counter, done_event: threading.Event):
+    # One event loop serves every worker connection; blocking SQLite work stays on the writer thread
+    job_queue: asyncio.Queue = asyncio.Queue()
     for ch in chunks:
-        job_queue.put(ch)
-
+        job_queue.put_nowait(ch)
     total_jobs = len(chunks)
-    results_counter = {"count": 0}
-    results_lock = threading.Lock()
+    if total_jobs == 0:
+        done_event.set()  # nothing to hand out, so no commit will ever signal completion
 
-    # Start socket server
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tune_socket(server_sock)  # buffer sizes are inherited by accepted sockets
     server_sock.bind((host, port))
     server_sock.listen(128)
     print(f"[Server] Listening on {host}:{port} ...")
 
-    # Accept loop
-    threads = []
-    def accept_loop():
-        while True:
-            try:
-                conn, addr = server_sock.accept()
-            except OSError:
-                break
-            t = threading.Thread(target=worker_handler, args=(conn, addr, job_queue, db_path, results_counter, results_lock), daemon=True)
-            t.start()
-            threads.append(t)
+    handlers = set()
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        handlers.add(task)
+        try:
+            await worker_handler(reader, writer, job_queue, results_queue)
+        finally:
+            handlers.discard(task)
+
+    server = await asyncio.start_server(on_connect, sock=server_sock)
+    try:
+        # Wait until the writer thread signals all chunks committed; the 1 s timeout
+        # only paces progress redraws (a racy read of the counter is fine for display)
+        while not done_event.is_set():
+            print(f"[Server] Progress: {results_counter['count']}/{total_jobs} chunks processed", end="\r")
+            await asyncio.to_thread(done_event.wait, 1.0)
+        print(f"[Server] Progress: {total_jobs}/{total_jobs} chunks processed", end="\r")
+    finally:
+        server.close()
+    # Let connected workers collect their NO_JOB and say BYE before the loop shuts down
+    if handlers:
+        await asyncio.wait(set(handlers), timeout=SHUTDOWN_GRACE)
 
-    accept_thread = threading.Thread(target=accept_loop, daemon=True)
-    accept_thread.start()
+def serve(csv_path: str, host: str, port: int, n_chunks: int, db_path: str, compression: Optional[str] = None):
+    print(f"[Server] Loading CSV: {csv_path}")
+    table = load_table(csv_path)
+    print(f"[Server] Loaded {table.num_rows:,} rows. Splitting into {n_chunks} chunks...")
+    chunks = build_chunks(table, n_chunks, compression)
+    del table
+    payload_bytes = sum(ch.payload.nbytes for ch in chunks)
+    print(f"[Server] Serialized {payload_bytes:,} payload bytes (compression: {compression or 'none'})")
 
-    # Wait until all chunks processed
+    print(f"[Server] Initializing DB at {db_path}")
+    db = DB(db_path)
+    db.init()
+
+    results_counter = {"count": 0, "dropped": 0}
+    results_lock = threading.Lock()
+    done_event = threading.Event()
+    results_queue: queue.Queue = queue.Queue()
+    agg = new_aggregate()
+    writer_thread = threading.Thread(target=writer_loop, args=(db, results_queue, results_counter, results_lock, agg, len(chunks), done_event), daemon=True)
+    writer_thread.start()
+
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        while True:
-            with results_lock:
-                done = results_counter["count"]
-            remaining = total_jobs - done
-            print(f"[Server] Progress: {done}/{total_jobs} chunks processed", end="\r")
-            if done >= total_jobs:
-                break
-            time.sleep(1)
+        run(coordinate(host, port, chunks, results_queue, results_counter, done_event))
     except KeyboardInterrupt:
         print("\n[Server] Shutting down on Ctrl+C")
     finally:
-        server_sock.close()
+        results_queue.put(None)
+        writer_thread.join()
+
+    db.close()
 
-    # Final aggregate
-    print("\n[Server] Computing final aggregate from DB...")
-    agg = final_aggregate(db_path)
-    print("[Server] Final results:")
-    print(agg)
+    # Final aggregate (maintained incrementally by the writer thread)
+    if results_counter["dropped"]:
+        print(f"\n[Server] WARNING: {results_counter['dropped']} result(s) could not be stored; the aggregate is incomplete")
+    print("\n[Server] Final results:")
+    print(finalize_aggregate(agg))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -170,8 +428,11 @@ def main():
     ap.add_argument("--port", type=int, default=5000, help="Server port")
     ap.add_argument("--chunks", type=int, default=100, help="Number of chunks to split")
     ap.add_argument("--db", default="results.sqlite", help="SQLite database file path")
+    ap.add_argument("--compress", choices=["none", "lz4", "zstd"], default="none",
+                    help="Compress JOB payloads (worth it when workers are on other hosts)")
     args = ap.parse_args()
-    serve(args.csv, args.host, args.port, args.chunks, args.db)
+    compression = None if args.compress == "none" else args.compress
+    serve(args.csv, args.host, args.port, args.chunks, args.db, compression)
 
 if __name__ == "__main__":
     main()
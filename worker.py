@@ -1,21 +1,27 @@
 """
 Worker node:
 - Connects to server, identifies with a worker_id
-- Repeatedly requests jobs (dataframe chunks), processes them, sends partial metrics
-- Exits when server sends NO_JOB
+- Repeatedly requests jobs (Arrow table chunks), processes them, sends partial metrics;
+  a reader thread prefetches the next chunk while the current one is reduced
+- Exits when server sends NO_JOB and all results are acknowledged
 
 Usage:
-    python worker.py --server 127.0.0.1 --port 5000 --worker-id w1
+    python worker.py --server 127.0.0.1 --port 5000 --worker-id w1 [--cpus 0,1]
 """
 
 import argparse
+import os
+import queue
 import socket
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional, Set
 
-import pandas as pd
-import pickle
+import numpy as np
+import numba
+import pyarrow as pa
+from numba import njit, prange
 
-from common import send_msg, recv_msg
+from common import send_msg, recv_msg, tune_socket, gc_paused
 
 # ---- Protocol message types ----
 MSG_HELLO = "HELLO"
@@ -24,79 +30,129 @@ MSG_JOB = "JOB"
 MSG_NO_JOB = "NO_JOB"
 MSG_RESULT = "RESULT"
 MSG_BYE = "BYE"
-
-def compute_metrics(df: pd.DataFrame) -> Dict[str, Any]:
-    # Try to robustly find price and quantity columns
-    cols = {c.lower(): c for c in df.columns}
-    price_col = None
-    for cand in ["price", "unitprice", "unit_price"]:
-        if cand in cols:
-            price_col = cols[cand]
-            break
-    if price_col is None:
-        raise ValueError(f"Could not find a price column among: {list(df.columns)}")
-
-    qty_col = None
-    for cand in ["quantity", "qty", "units"]:
-        if cand in cols:
-            qty_col = cols[cand]
-            break
-    if qty_col is None:
-        raise ValueError(f"Could not find a quantity column among: {list(df.columns)}")
-
-    prices = pd.to_numeric(df[price_col], errors="coerce")
-    qty = pd.to_numeric(df[qty_col], errors="coerce").fillna(0)
-
-    # Rows considered: where price is not NaN
-    valid = prices.notna()
-    prices = prices[valid]
-    qty = qty[valid]
-
-    rows_processed = int(valid.sum())
-    total_sales = float((prices * qty).sum())
-
-    min_price = float(prices.min()) if rows_processed else 0.0
-    max_price = float(prices.max()) if rows_processed else 0.0
-    avg_price = float(prices.mean()) if rows_processed else 0.0
+MSG_ERROR = "ERROR"
+
+# ---- Column names in JOB payloads ----
+PRICE_COL = "price"
+QTY_COL = "quantity"
+
+PREFETCH_DEPTH = 2  # server messages buffered ahead of the compute loop
+
+# fastmath minus nnan/ninf: the kernel relies on NaN checks to skip missing values.
+# nogil lets the socket reader thread keep receiving while the kernel runs.
+@njit(cache=True, parallel=True, nogil=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"})
+def _reduce(prices, qty):
+    # Single fused pass: count, sum, sum(price*qty), min, max over rows with a price
+    n = 0
+    s_p = 0.0
+    s_pq = 0.0
+    mn = np.inf
+    mx = -np.inf
+    for i in prange(prices.shape[0]):
+        p = prices[i]
+        if not np.isnan(p):
+            q = qty[i]
+            n += 1
+            s_p += p
+            pq = np.float64(p) * q
+            if not np.isnan(pq):  # missing quantity or inf * 0: skipped, like pandas' sum
+                s_pq += pq
+            mn = min(mn, p)
+            mx = max(mx, p)
+    return n, s_p, s_pq, mn, mx
+
+def compute_metrics(table: pa.Table) -> Dict[str, Any]:
+    # Server has already selected and coerced the price/quantity columns (nulls -> NaN here)
+    # float32 inputs; _reduce accumulates sums in float64
+    prices = table.column(PRICE_COL).to_numpy().astype(np.float32, copy=False)
+    qty = table.column(QTY_COL).to_numpy().astype(np.float32, copy=False)
+
+    # Rows considered: where price is not NaN; missing quantity counts as 0
+    rows_processed, s_p, s_pq, mn, mx = _reduce(prices, qty)
+
+    total_sales = float(s_pq)
+    min_price = float(mn) if rows_processed else 0.0
+    max_price = float(mx) if rows_processed else 0.0
+    avg_price = float(s_p / rows_processed) if rows_processed else 0.0
 
     return {
-        "rows_processed": rows_processed,
+        "rows_processed": int(rows_processed),
         "total_sales": total_sales,
         "min_price": min_price,
         "max_price": max_price,
         "avg_price": avg_price,
     }
 
-def run_worker(server_host: str, server_port: int, worker_id: str):
+def deserialize_table(data: bytes) -> pa.Table:
+    # Arrow IPC stream -> Table; column buffers reference `data` without copying
+    with gc_paused():
+        return pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+
+def io_loop(sock: socket.socket, send_lock: threading.Lock, events: queue.Queue):
+    # Sole reader of the socket. Forwards every server message to the compute loop and
+    # asks for the next job as soon as one arrives, so the transfer of chunk N+1
+    # overlaps the reduction of chunk N. The bounded queue caps how far it runs ahead.
+    try:
+        with send_lock:
+            send_msg(sock, {"type": MSG_GET_JOB})
+        while True:
+            msg = recv_msg(sock)
+            events.put(msg)
+            if msg.get("type") == MSG_JOB:
+                with send_lock:
+                    send_msg(sock, {"type": MSG_GET_JOB})
+    except Exception as e:
+        events.put(e)
+
+def run_worker(server_host: str, server_port: int, worker_id: str, cpus: Optional[Set[int]] = None):
+    if cpus:
+        # Keep the process (and Numba's threads) on fixed cores to avoid migrations
+        os.sched_setaffinity(0, cpus)
+        # Numba sizes its pool from the machine's core count; match it to the pinned set
+        numba.set_num_threads(min(len(cpus), numba.config.NUMBA_NUM_THREADS))
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(sock)
     sock.connect((server_host, server_port))
 
     # Introduce ourselves
     send_msg(sock, {"type": MSG_HELLO, "worker_id": worker_id})
 
+    send_lock = threading.Lock()
+    events: queue.Queue = queue.Queue(maxsize=PREFETCH_DEPTH)
+    threading.Thread(target=io_loop, args=(sock, send_lock, events), daemon=True).start()
+
+    sent = acked = 0
+    no_more_jobs = False
     try:
-        while True:
-            # Ask for a job
-            send_msg(sock, {"type": MSG_GET_JOB})
-            msg = recv_msg(sock)
+        # Run until the server is out of jobs and every RESULT has been acknowledged
+        while not (no_more_jobs and acked >= sent):
+            msg = events.get()
+            if isinstance(msg, Exception):
+                raise ConnectionError(f"Lost connection to server: {msg}") from msg
             mtype = msg.get("type")
             if mtype == MSG_NO_JOB:
                 # Done
-                break
+                no_more_jobs = True
             elif mtype == MSG_JOB:
                 chunk_id = msg["chunk_id"]
-                df = pickle.loads(msg["data"])
-                metrics = compute_metrics(df)
+                table = deserialize_table(msg["body"])
+                metrics = compute_metrics(table)
                 record = {"worker_id": worker_id, "chunk_id": chunk_id, **metrics}
-                send_msg(sock, {"type": MSG_RESULT, "record": record})
-                # Wait for ACK (optional)
-                ack = recv_msg(sock)
+                with send_lock:
+                    send_msg(sock, {"type": MSG_RESULT, "record": record})
+                sent += 1
+            elif mtype == "ACK":
+                acked += 1
+            elif mtype == MSG_ERROR:
+                raise RuntimeError(f"Server rejected a message: {msg.get('error')}")
             else:
                 # Unexpected message; continue
                 continue
     finally:
         try:
-            send_msg(sock, {"type": MSG_BYE})
+            with send_lock:
+                send_msg(sock, {"type": MSG_BYE})
         except Exception:
             pass
         sock.close()
@@ -106,10 +162,12 @@ def main():
     ap.add_argument("--server", required=True, help="Server host")
     ap.add_argument("--port", type=int, default=5000, help="Server port")
     ap.add_argument("--worker-id", default=None, help="Worker identifier string")
+    ap.add_argument("--cpus", default=None, help="Comma-separated CPU cores to pin this worker to (Linux only)")
     args = ap.parse_args()
 
     worker_id = args.worker_id or socket.gethostname()
-    run_worker(args.server, args.port, worker_id)
+    cpus = {int(c) for c in args.cpus.split(",")} if args.cpus else None
+    run_worker(args.server, args.port, worker_id, cpus)
 
 if __name__ == "__main__":
     main()